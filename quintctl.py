@@ -3,11 +3,15 @@
 # Author: Mario Kicherer (dev@kicherer.org)
 #
 
-import argparse, sys, time
+import argparse, asyncio, heapq, struct, sys, time
+from array import array
+from bisect import bisect_left
+from dataclasses import dataclass
+from typing import Callable, NamedTuple
 from datetime import datetime
 
-from pymodbus.client import ModbusSerialClient
-from pymodbus.exceptions import ModbusException
+from pymodbus.client import AsyncModbusSerialClient, ModbusSerialClient
+from pymodbus.exceptions import ConnectionException, ModbusException, ModbusIOException
 from pymodbus.pdu import ExceptionResponse
 from pymodbus.transaction import ModbusRtuFramer
 
@@ -280,10 +284,29 @@ default_skip = [
 	0x7478,
 	]
 
+# seconds between two reads of a register in monitor mode if the register
+# does not specify a "poll_interval". monitor reads whole ranges from
+# Quint24DCMonitorRegisters, so a range is read at the shortest interval
+# of the monitored registers inside it and never less often than this.
+DEFAULT_POLL_INTERVAL = 1.0
+
+# maximum number of registers in a single read request
+MODBUS_MAX_READ = 0x7d
+# request size monitor falls back to if the device refuses larger reads
+FALLBACK_READ = 0x10
+
+# limit for coalesced reads, below the Modbus maximum of 125 registers
+MAX_REGS = 64
+# reading a few unused registers is cheaper than another RTU transaction
+GAP_THRESHOLD = 4
+
 class QuintUPS():
 	def __init__(self):
 		self.slave_id = 192
 		self.baudrate = 115200
+		# True if the device answered the last failed request with a Modbus
+		# exception response instead of the transfer itself failing
+		self.rejected = False
 	
 	def connect(self, device):
 		self.mbclient = ModbusSerialClient(
@@ -296,89 +319,383 @@ class QuintUPS():
 			)
 		
 		self.mbclient.connect()
+		self.tuneSerial()
+	
+	async def connectAsync(self, device):
+		self.mbclient = AsyncModbusSerialClient(
+				device,
+				framer=ModbusRtuFramer,
+				baudrate=self.baudrate,
+				bytesize=8,
+				parity="E",
+				stopbits=1,
+			)
+		
+		await self.mbclient.connect()
+	
+	def tuneSerial(self):
+		# pymodbus waits until the line is quiet before it reads the response.
+		# As the transaction manager already requests the expected number of
+		# bytes, let pyserial block until they have arrived instead.
+		orig_recv = self.mbclient.recv
+		def recv(size):
+			if size is None or getattr(self.mbclient, "socket", None) is None:
+				return orig_recv(size)
+			return self.mbclient.socket.read(size)
+		self.mbclient.recv = recv
 	
 	def __del__(self):
 		self.mbclient.close()
 	
+	def _with_retry(self, fn, *args, retries=1, backoff=0.1):
+		# call fn and reopen the serial port if the connection failed.
+		# pymodbus itself already retries a request a few times and
+		# reconnects in execute(), so only connection and I/O errors,
+		# where a freshly opened port can help, are retried here.
+		self.rejected = False
+		for attempt in range(retries + 1):
+			if attempt > 0:
+				self.mbclient.close()
+				self.mbclient.connect()
+				time.sleep(backoff)
+			
+			try:
+				resp = fn(*args, slave=self.slave_id)
+			except (ConnectionException, ModbusIOException) as e:
+				print(f"Received ModbusException({e}) from library")
+				continue
+			except ModbusException as e:
+				print(f"Received ModbusException({e}) from library")
+				return None
+			
+			if isinstance(resp, ExceptionResponse):
+				print(f"Received Modbus library exception ({resp})")
+				# THIS IS NOT A PYTHON EXCEPTION, but a valid modbus message,
+				# so the connection itself is fine and a retry will not help
+				self.rejected = True
+				return None
+			
+			if resp.isError():
+				print(f"Received Modbus library error({resp})")
+				if isinstance(resp, ModbusIOException):
+					continue
+				return None
+			
+			return resp
+		
+		return None
+	
 	def readRegister(self, addr, count=1):
 		if count == 0:
-			#count = 0x7d
-			count = 0x10
+			count = MODBUS_MAX_READ
+		
+		resp = self._with_retry(self.mbclient.read_input_registers, addr, count)
+		if resp is None:
+			return None
 		
+		return resp.registers
+	
+	async def readRegisterAsync(self, addr, count=1):
+		# the async client reconnects on its own after connection errors
+		self.rejected = False
 		try:
-			resp = self.mbclient.read_input_registers(addr, count, slave=self.slave_id)
+			resp = await self.mbclient.read_input_registers(addr, count, slave=self.slave_id)
 		except ModbusException as e:
 			print(f"Received ModbusException({e}) from library")
-			self.mbclient.close()
-			return None
-
-		if resp.isError():
-			print(f"Received Modbus library error({resp})")
-			self.mbclient.close()
 			return None
-
+		
 		if isinstance(resp, ExceptionResponse):
 			print(f"Received Modbus library exception ({resp})")
-			# THIS IS NOT A PYTHON EXCEPTION, but a valid modbus message
-			self.mbclient.close()
+			self.rejected = True
+			return None
+		
+		if resp.isError():
+			print(f"Received Modbus library error({resp})")
 			return None
 		
 		return resp.registers
 	
+	def readRegisterBytes(self, addr, count=1):
+		# registers packed by pack_registers(), decode with decode_registers()
+		values = self.readRegister(addr, count=count)
+		if values is None:
+			return None
+		
+		return pack_registers(values)
+	
+	def readRange(self, start, end):
+		# read all registers in [start, end) with as few requests as possible
+		values = []
+		for addr in range(start, end, MODBUS_MAX_READ):
+			chunk = self.readRegister(addr, count=min(MODBUS_MAX_READ, end - addr))
+			if chunk is None:
+				return None
+			values.extend(chunk)
+		return values
+	
+	def readSpans(self, entries):
+		# group entries sorted by address into spans that can be read with
+		# a single request
+		spans = []
+		for entry in entries:
+			if spans:
+				span = spans[-1]
+				if entry.addr - span["start"] + entry.length <= MAX_REGS and entry.addr - span["end"] <= GAP_THRESHOLD:
+					span["end"] = max(span["end"], entry.addr + entry.length)
+					span["entries"].append(entry)
+					continue
+			
+			spans.append({"start": entry.addr, "end": entry.addr + entry.length, "entries": [entry]})
+		
+		for span in spans:
+			values = self.readRegister(span["start"], count=span["end"] - span["start"])
+			
+			for entry in span["entries"]:
+				if values:
+					offset = entry.addr - span["start"]
+					yield entry, values[offset:offset+entry.length]
+				elif len(span["entries"]) == 1:
+					yield entry, values
+				else:
+					# fall back to reading the register on its own
+					yield entry, self.readRegister(entry.addr, count=entry.length)
+	
 	def writeRegister(self, addr, value):
-		try:
-			# using write_register() results in illegalfunction exception
-			resp = self.mbclient.write_registers(addr, [value], slave=self.slave_id)
-		except ModbusException as e:
-			print(f"Received ModbusException({e}) from library")
-			self.mbclient.close()
+		# using write_register() results in illegalfunction exception
+		resp = self._with_retry(self.mbclient.write_registers, addr, [value])
+		if resp is None:
 			return None
+		
+		return True
 
-		if resp.isError():
-			print(f"Received Modbus library error({resp})")
-			self.mbclient.close()
-			return None
+def pack_registers(vals):
+	# the device stores values spanning multiple registers low word first,
+	# so with every register packed little endian the whole buffer is a
+	# single little endian integer
+	return struct.pack(f"<{len(vals)}H", *vals)
 
-		if isinstance(resp, ExceptionResponse):
-			print(f"Received Modbus library exception ({resp})")
-			# THIS IS NOT A PYTHON EXCEPTION, but a valid modbus message
-			self.mbclient.close()
-			return None
+def decode_registers(raw):
+	return int.from_bytes(raw, "little")
+
+def combine(vals):
+	return decode_registers(pack_registers(vals))
+
+def build_formatter(regdict):
+	values = regdict.get("values")
+	if callable(values):
+		return values
+	
+	if regdict.get("type") == "bool":
+		fmt = lambda value: "on" if value else "off"
+	elif regdict.get("type") == "bits":
+		bit_table = dict(regdict["bits"])
+		active_mask = sum(1 << bit for bit in bit_table)
 		
-		return True
+		def fmt(value):
+			lines = [str(value)]
+			
+			# only visit the bits that are set, lowest first
+			set_bits = value & active_mask
+			while set_bits:
+				lowest = set_bits & -set_bits
+				lines.append(" - "+bit_table[lowest.bit_length() - 1])
+				set_bits ^= lowest
+			
+			return "\n".join(lines)
+	else:
+		unit = regdict.get("unit", "")
+		fmt = lambda value: f"{value} {unit}"
+	
+	if isinstance(values, dict):
+		default_fmt = fmt
+		fmt = lambda value: values[value] if value in values else default_fmt(value)
+	
+	return fmt
+
+class Entry(NamedTuple):
+	name: str
+	addr: int
+	length: int
+	formatter: Callable
+	regdict: dict
+
+@dataclass(frozen=True)
+class RuntimeTables:
+	addr_index: dict
+	name_index: dict
+	# entries and their addresses, sorted by address
+	entries: list
+	sorted_addrs: array
+	default_skip_addrs: frozenset
+	
+	def addr_range(self, start, end):
+		# entries with start <= addr < end
+		return self.entries[bisect_left(self.sorted_addrs, start):bisect_left(self.sorted_addrs, end)]
+
+def _build_tables():
+	# resolve the register definitions into the lookup tables used by the actions
+	entries = [
+		Entry(reg, regdict["addr"], regdict.get("length", 1), build_formatter(regdict), regdict)
+		for reg, regdict in Quint24DCRegisters.items()
+		]
+	entries.sort(key=lambda entry: entry.addr)
+	
+	name_index = {entry.name: entry for entry in entries}
+	
+	return RuntimeTables(
+		addr_index={entry.addr: entry for entry in entries},
+		name_index=name_index,
+		entries=entries,
+		sorted_addrs=array("I", (entry.addr for entry in entries)),
+		default_skip_addrs=frozenset(name_index[x].addr if isinstance(x, str) else x for x in default_skip),
+		)
+
+def resolve_param(tables, param):
+	# returns (addr, length, entry or None) for a register name or address
+	entry = tables.name_index.get(param)
+	if entry is not None:
+		return entry.addr, entry.length, entry
+	
+	try:
+		param_addr = int(param, 0)
+	except ValueError:
+		return None
+	
+	entry = tables.addr_index.get(param_addr)
+	if entry is not None:
+		return entry.addr, entry.length, entry
+	
+	return param_addr, 1, None
+
+def print_named(entry, value, prefix=""):
+	print(f"{prefix}{entry.name}: {entry.formatter(value)}")
 
-def print_value(info, values, prefix=""):
-	if isinstance(info, dict):
-		regdict = info
+def print_raw(addr, value, prefix=""):
+	print(f"{prefix}0x{addr:02x} {value}")
+
+async def monitor(quintups, args, tables):
+	await quintups.connectAsync(args.device)
+	
+	prior = {}
+	skip_addr = set(tables.default_skip_addrs)
+	if args.skip_addr:
+		for a in args.skip_addr:
+			skip_addr.update(int(x, 0) for x in a.split(","))
+	skip_addr = frozenset(skip_addr)
+	
+	# split each range into requests of at most MODBUS_MAX_READ registers and poll
+	# the range as often as its most frequently changing register requires
+	spans = []
+	for start, end in Quint24DCMonitorRegisters:
+		chunks = [(addr, min(MODBUS_MAX_READ, end - addr)) for addr in range(start, end, MODBUS_MAX_READ)]
+		# unnamed registers are read at the default interval, so a register
+		# can only make its range faster, and skipped ones do not count
+		interval = min([DEFAULT_POLL_INTERVAL] + [entry.regdict.get("poll_interval", DEFAULT_POLL_INTERVAL)
+			for entry in tables.addr_range(start, end) if entry.addr not in skip_addr])
 		
-		if isinstance(values, list):
-			if len(values) == 1:
-				value = values[0]
-			else:
-				value=0
-				for i in range(len(values)):
-					value |= (values[i] << (16*i))
-		else:
-			value = values
+		# (addr, offset into the range, length, entry or None)
+		plan = []
+		addr = start
+		while addr < end:
+			entry = tables.addr_index.get(addr)
+			length = entry.length if entry else 1
+			if addr not in skip_addr:
+				plan.append((addr, addr - start, length, entry))
+			addr += length
 		
-		if "values" in regdict and isinstance(regdict["values"], dict) and value in regdict["values"]:
-			print(prefix+reg+":", regdict["values"][value])
-		elif "values" in regdict and callable(regdict["values"]):
-			print(prefix+reg+":", regdict["values"](value))
-		elif "type" in regdict and regdict["type"] == "bool":
-			print(prefix+reg+":", "on" if value else "off")
-		elif regdict.get("type", None) == "int":
-			print(prefix+reg+":", value, regdict["unit"] if "unit" in regdict else "")
-		elif regdict.get("type", None) == "bits":
-			print(prefix+reg+":", value)
+		spans.append((start, end, chunks, interval, plan))
+	
+	def rel_change(old, new):
+		return abs(new - old)/old
+	
+	async def read_span(span_id):
+		chunks = spans[span_id][2]
+		values = []
+		i = 0
+		while i < len(chunks):
+			addr, count = chunks[i]
+			chunk = await quintups.readRegisterAsync(addr, count=count)
+			if chunk is None:
+				if not quintups.rejected or count <= FALLBACK_READ:
+					# e.g. a timeout, skip this cycle and read the
+					# unchanged chunks again next time
+					return None
+				
+				# the device refused the large request, split this chunk into
+				# smaller ones and keep using them for the following cycles
+				chunks[i:i+1] = [(a, min(FALLBACK_READ, addr + count - a)) for a in range(addr, addr + count, FALLBACK_READ)]
+				continue
 			
-			for bit, descr in regdict["bits"].items():
-				if ((value >> bit) & 1) == 1:
-					print(" - "+descr)
-		else:
-			print(prefix+reg+":", value, regdict["unit"] if "unit" in regdict else "")
-	else:
-		print(prefix+"0x%02x"%info, values)
+			values.extend(chunk)
+			i += 1
+		return values
+	
+	def show_changes(span_id, values):
+		now = datetime.now().strftime("%H:%M:%S")
+		
+		for addr, offset, length, entry in spans[span_id][4]:
+			# compare the raw registers, only decode them if they changed
+			if length == 1:
+				raw = values[offset]
+			else:
+				raw = tuple(values[offset:offset+length])
+			
+			old = prior.get(addr, None)
+			prior[addr] = raw
+			if old is None or old == raw:
+				continue
+			
+			if length == 1:
+				value, old_value = raw, old
+			else:
+				value, old_value = combine(raw), combine(old)
+			
+			show = True
+			if args.min_change_rel is not None and old_value:
+				show = rel_change(old_value, value) > args.min_change_rel
+			
+			if show and args.min_change_abs is not None:
+				show = abs(old_value - value) > args.min_change_abs
+			
+			if show:
+				if entry:
+					print_named(entry, value, prefix=now+" ")
+				else:
+					print_raw(addr, value, prefix=now+" ")
+	
+	loop = asyncio.get_running_loop()
+	
+	# min-heap of (deadline, span index)
+	queue = []
+	deadline = loop.time()
+	for span_id in range(len(spans)):
+		heapq.heappush(queue, (deadline, span_id))
+	
+	def start_read():
+		deadline, span_id = heapq.heappop(queue)
+		heapq.heappush(queue, (deadline + spans[span_id][3], span_id))
+		return span_id, asyncio.create_task(read_span(span_id))
+	
+	pending = None
+	while True:
+		if pending is None:
+			delay = queue[0][0] - loop.time()
+			if delay > 0:
+				await asyncio.sleep(delay)
+			pending = start_read()
+		
+		span_id, task = pending
+		values = await task
+		pending = None
+		
+		# if the next range is already due, send its request before the
+		# values of this one are processed
+		if queue[0][0] <= loop.time():
+			pending = start_read()
+			await asyncio.sleep(0)
+		
+		if values is not None:
+			show_changes(span_id, values)
 
 if __name__ == "__main__":
 	parser = argparse.ArgumentParser()
@@ -392,122 +709,80 @@ if __name__ == "__main__":
 	parser.add_argument("action", default="dump", nargs="?", choices={"dump", "dumpall", "monitor", "get", "set"})
 	parser.add_argument("action_params", nargs="*")
 	args = parser.parse_args()
+	
+	tables = _build_tables()
 
 	quintups = QuintUPS()
-	quintups.connect(args.device)
+	if args.action != "monitor":
+		quintups.connect(args.device)
 
 	if args.action == "dump":
-		for reg, regdict in Quint24DCRegisters.items():
-			values = quintups.readRegister(regdict["addr"], count=regdict.get("length", 1))
+		results = {}
+		for start, end in Quint24DCMonitorRegisters:
+			regs = quintups.readRange(start, end)
+			if regs is None:
+				continue
+			
+			for entry in tables.addr_range(start, end):
+				offset = entry.addr - start
+				results[entry.name] = regs[offset:offset+entry.length]
+		
+		# registers outside of the ranges or whose range could not be read
+		rest = [entry for entry in tables.entries if entry.name not in results]
+		for entry, values in quintups.readSpans(rest):
+			results[entry.name] = values
+		
+		# print in the order of the definitions, which groups them by section
+		for reg in Quint24DCRegisters:
+			entry = tables.name_index[reg]
+			values = results[entry.name]
 			if values:
 				if args.raw:
-					print(reg+":", values, regdict["unit"] if "unit" in regdict else "")
+					print(entry.name+":", values, entry.regdict["unit"] if "unit" in entry.regdict else "")
 					continue
 				
-				print_value(regdict, values)
+				print_named(entry, combine(values))
 	elif args.action == "dumpall":
-		i = 0x7400
-		while i < 0x7500:
-			values = quintups.readRegister(i)
-			
-			found=False
-			for reg, regdict in Quint24DCRegisters.items():
-				if regdict["addr"] == i:
-					i += regdict.get("length", 1) - 1
-					
-					print_value(regdict, values)
-					
-					found=True
-					break
-			
-			if not found and values != [65535]:
-				print_value(i, values)
-			
-			i += 1
-	elif args.action == "monitor":
-		prior = {}
-		first = True
-		skip_addr = []
-		if args.skip_addr:
-			for a in args.skip_addr:
-				arr = a.split(",")
-				skip_addr.extend(arr)
-			skip_addr = [ int(a, 0) for a in skip_addr ]
+		start, end = 0x7400, 0x7500
 		
-		for entry in default_skip:
-			if isinstance(entry, str):
-				skip_addr.append(Quint24DCRegisters[entry]["addr"])
-			else:
-				skip_addr.append(entry)
+		regs = quintups.readRange(start, end)
+		if regs is None:
+			if not quintups.rejected:
+				sys.exit(1)
+			
+			# the device refused a large request, fall back to smaller ones
+			regs = []
+			for addr in range(start, end, FALLBACK_READ):
+				count = min(FALLBACK_READ, end - addr)
+				values = quintups.readRegister(addr, count=count)
+				if values is None and not quintups.rejected:
+					sys.exit(1)
+				regs.extend(values if values else [None] * count)
 		
-		def rel_change(old, new):
-			return abs(new - old)/old
+		known = tables.addr_range(start, end)
 		
-		while True:
-			for start, end in Quint24DCMonitorRegisters: 
-				values = []
-				while len(values) < end - start:
-					values.extend( quintups.readRegister(start + len(values), count=0) )
+		k = 0
+		i = start
+		while i < end:
+			while k < len(known) and known[k].addr < i:
+				k += 1
+			
+			if k < len(known) and known[k].addr == i:
+				entry = known[k]
 				
-				# print(values)
+				values = regs[i-start:i-start+entry.length]
+				if None not in values:
+					print_named(entry, combine(values))
 				
-				idx = 0
-				while idx < len(values):
-					addr = start + idx
-					
-					idx_inc = 1
-					cur_regdict = None
-					for reg, regdict in Quint24DCRegisters.items():
-						if regdict["addr"] == addr:
-							cur_regdict = regdict
-							idx_inc = cur_regdict.get("length", 1)
-							break
-					
-					if addr in skip_addr:
-						idx += idx_inc
-						continue
-					
-					now = datetime.now().strftime("%H:%M:%S")
-					if cur_regdict:
-						vals = values[idx:idx+cur_regdict.get("length", 1)]
-						
-						if len(vals) == 1:
-							value = vals[0]
-						else:
-							value=0
-							for i in range(len(vals)):
-								value |= (vals[i] << (16*i))
-						
-						if not first:
-							show = prior.get(addr, None) != value
-							if show and args.min_change_rel is not None and prior.get(addr, None):
-								show = rel_change(prior.get(addr, None), value) > args.min_change_rel
-							
-							if show and args.min_change_abs is not None:
-								show = abs(prior.get(addr, None) - value) > args.min_change_abs
-							
-							if show:
-								print_value(cur_regdict, value, prefix=now+" ")
-								# print("\t", prior.get(addr, None))
-					else:
-						value = values[idx]
-						if not first:
-							show = prior.get(addr, None) != value
-							if show and args.min_change_rel is not None and prior.get(addr, None):
-								show = rel_change(prior.get(addr, None), value) > args.min_change_rel
-							
-							if show and args.min_change_abs is not None:
-								show = abs(prior.get(addr, None) - value) > args.min_change_abs
-							
-							if show:
-								print_value(addr, value, prefix=now+" ")
-								# print("\t", prior.get(addr, None))
-					
-					prior[addr] = value
-					idx += idx_inc
-			
-			time.sleep(1)
-			first = False
+				i += entry.length
+			else:
+				value = regs[i-start]
+				if value is not None and value != 65535:
+					print_raw(i, [value])
+				
+				i += 1
+	elif args.action == "monitor":
+		asyncio.run(monitor(quintups, args, tables))
 	elif args.action == "get":
 		if len(args.action_params) == 0:
 			print("missing parameter", file=sys.stderr)
@@ -517,54 +792,48 @@ if __name__ == "__main__":
 			repeat = 1
 		else:
 			repeat = args.repeat
+		
+		# resolve the parameters once: (addr, length, entry or None)
+		plan = [resolve_param(tables, param) for param in args.action_params]
+		if None in plan:
+			print("error, register not found")
+			sys.exit(1)
+		
 		while repeat != 0:
-			for param in args.action_params:
-				try:
-					param_addr = int(param, 0)
-				except:
-					param_addr = None
+			cycle_start = time.monotonic()
+			
+			# issue all requests back to back and format the values afterwards
+			results = [quintups.readRegisterBytes(addr, count=length) for addr, length, entry in plan]
+			
+			for (addr, length, entry), raw in zip(plan, results):
+				if not raw:
+					continue
 				
-				values = None
-				for reg, regdict in Quint24DCRegisters.items():
-					if param == reg or param_addr == regdict["addr"]:
-						values = quintups.readRegister(regdict["addr"], count=regdict.get("length", 1))
-						
-						print_value(regdict, values)
-						break
-					
-				if values is None:
-					values = quintups.readRegister(param_addr)
-					
-					print_value(param_addr, values)
+				if entry:
+					print_named(entry, decode_registers(raw))
+				else:
+					print_raw(addr, [decode_registers(raw)])
 			
 			if repeat > 0:
 				repeat -= 1
-			time.sleep(0.1)
+			
+			# the requests themselves may already take longer than the interval
+			delay = 0.1 - (time.monotonic() - cycle_start)
+			if repeat != 0 and delay > 0:
+				time.sleep(delay)
 	elif args.action == "set":
 		if len(args.action_params) != 2:
 			print("wrong parameter", file=sys.stderr)
 			sys.exit(1)
 		
-		try:
-			param_addr = int(args.action_params[0], 0)
-		except:
-			param_addr = None
-		
 		value = int(args.action_params[1], 0)
 		
-		found = False
-		for reg, regdict in Quint24DCRegisters.items():
-			if args.action_params[0] == reg or param_addr == regdict["addr"]:
-				quintups.writeRegister(regdict["addr"], value)
-				found = True
-				break
+		resolved = resolve_param(tables, args.action_params[0])
+		if resolved is None:
+			print("error, register not found")
+			sys.exit(1)
 		
-		if not found:
-			if param_addr is None:
-				print("error, register not found")
-				sys.exit(1)
-			else:
-				quintups.writeRegister(param_addr, value)
+		quintups.writeRegister(resolved[0], value)
 	else:
 		print("unknown action")
 		sys.exit(1)